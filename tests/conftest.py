@@ -0,0 +1,87 @@
+# Copyright ©2022-2023. The Regents of the University of California
+# (Regents). All Rights Reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met: 
+
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer. 
+
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the 
+# documentation and/or other materials provided with the
+# distribution. 
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import tempfile
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from pyspark.sql import SparkSession
+
+from helpers.utils import build_config_from_file, get_spark_session
+
+PROJECT_ROOT = Path(__file__).parent.parent
+
+
+def pytest_configure(config) -> None:
+    """
+    Give each pytest-xdist worker its own Spark scratch space, so that parallel Spark sessions don't collide
+    """
+    worker_id = os.environ.get('PYTEST_XDIST_WORKER', 'master')
+
+    # Values already set in the environment are respected. Bind the driver to localhost by default, so that workers
+    # don't each resolve (and race on) the host's network address
+    os.environ.setdefault('SPARK_LOCAL_IP', '127.0.0.1')
+
+    # The xdist controller runs no tests, and its workers inherit its environment: leave SPARK_LOCAL_DIRS untouched
+    if worker_id == 'master' and config.getoption('dist', 'no') != 'no':
+        return
+
+    # SPARK_LOCAL_DIRS takes precedence over spark.local.dir, which would otherwise be shared by all workers. Each
+    # worker gets its own subdirectory under every configured dir (or under the system tempdir if none is set)
+    base_dirs = os.environ.get('SPARK_LOCAL_DIRS') or str(Path(tempfile.gettempdir()) / 'cider_spark')
+    spark_local_dirs = [Path(base_dir) / worker_id for base_dir in base_dirs.split(',')]
+    for spark_local_dir in spark_local_dirs:
+        spark_local_dir.mkdir(parents=True, exist_ok=True)
+    os.environ['SPARK_LOCAL_DIRS'] = ','.join(str(spark_local_dir) for spark_local_dir in spark_local_dirs)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_modifyitems(config, items) -> None:
+    """
+    Send all tests of a given datastore class to the same xdist worker (under --dist=loadgroup), so that they share
+    its session-scoped datastore. Runs before xdist reads the groups; tests with an explicit group keep it.
+    """
+    for item in items:
+        callspec = getattr(item, 'callspec', None)
+        if callspec is None or 'datastore_class' not in callspec.params:
+            continue
+        if item.get_closest_marker('xdist_group') is None:
+            item.add_marker(pytest.mark.xdist_group(name=callspec.params['datastore_class'].__name__))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def spark_session() -> Iterator[SparkSession]:
+    """
+    Create the Spark session once per worker, to be shared by every datastore the tests build, and stop it once the
+    worker is done
+    """
+    cfg = build_config_from_file(str(PROJECT_ROOT / 'configs' / 'test_config.yml'))
+    spark = get_spark_session(cfg)
+    yield spark
+    spark.stop()
@@ -25,54 +25,128 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import copy
+import functools
 import os
 from pathlib import Path
 
 from datetime import datetime, timedelta
 import geopandas
 from geopandas import GeoDataFrame  # type: ignore[import]
-import numpy as np
 import pandas as pd
 from pandas import DataFrame as PandasDataFrame, Series
-from pyspark.sql import DataFrame as SparkDataFrame
+from pyspark.sql import DataFrame as SparkDataFrame, SparkSession
+from pyspark.sql.readwriter import DataFrameReader
 from pyspark.sql import functions as F
 from pyspark.sql.functions import col
 from pyspark.sql.utils import AnalysisException
-from typing import Dict, MutableMapping, Type
+from typing import Callable, Dict, MutableMapping, Optional, Tuple, Type
 
 import pytest
 from pytest_mock import mocker, MockerFixture
+from unittest.mock import create_autospec
 
 from cider.datastore import DataStore, DataType, OptDataStore
-from helpers.utils import get_spark_session
+from helpers.utils import get_spark_session, make_dir
 
+# Factories, rather than dataframes, so that only the cases selected for a run get built
 malformed_dataframes_and_errors = {
-    'cdr': [(pd.DataFrame(
+    'cdr': [(lambda: pd.DataFrame(
         data={'txn_type': ['text'], 'caller_id': ['A'], 'recipient_id': ['B'], 'timestamp': ['2021-01-01']}),
              ValueError),
-        (pd.DataFrame(data={'txn_type': ['text_message'], 'caller_id': ['A'], 'recipient_id': ['B'],
-                            'timestamp': ['2021-01-01'], 'duration': [60], 'international': ['domestic']}),
+        (lambda: pd.DataFrame(data={'txn_type': ['text_message'], 'caller_id': ['A'], 'recipient_id': ['B'],
+                                    'timestamp': ['2021-01-01'], 'duration': [60], 'international': ['domestic']}),
          ValueError)],
-    'antennas': [(pd.DataFrame(data={'antenna_id': ['1'], 'latitude': ['10']}), ValueError)],
-    'recharges': [(pd.DataFrame(data={'caller_id': ['A'], 'amount': ['100']}), ValueError),
-                  (pd.DataFrame(data={'caller_id': ['A'], 'timestamp': ['2020-01-01']}), ValueError)],
-    'mobiledata': [(pd.DataFrame(data={'caller_id': ['A'], 'timestamp': ['2021-01-01']}), ValueError),
-                   (pd.DataFrame(data={'caller_id': ['A'], 'volume': ['100']}), ValueError)],
-    'mobilemoney': [(pd.DataFrame(data={'txn_type': ['cashin'], 'caller_id': ['A'], 'recipient_id': ['B'],
-                                        'timestamp': ['2021-01-01']}), ValueError),
-                    (pd.DataFrame(data={'txn_type': ['cash-in'], 'caller_id': ['A'], 'recipient_id': ['B'],
-                                        'timestamp': ['2021-01-01'], 'amount': [10]}), ValueError)],
-    'shapefiles': [(pd.DataFrame(data={'region': ['X']}), ValueError),
-                   (pd.DataFrame(data={'geometry': ['A']}), ValueError),
-                   (pd.DataFrame(data={'region': ['X'], 'geometry': ['A']}), AssertionError)],
-    'labels': [(pd.DataFrame(data={'name': ['A']}), ValueError),
-               (pd.DataFrame(data={'label': ['50']}), ValueError)]
+    'antennas': [(lambda: pd.DataFrame(data={'antenna_id': ['1'], 'latitude': ['10']}), ValueError)],
+    'recharges': [(lambda: pd.DataFrame(data={'caller_id': ['A'], 'amount': ['100']}), ValueError),
+                  (lambda: pd.DataFrame(data={'caller_id': ['A'], 'timestamp': ['2020-01-01']}), ValueError)],
+    'mobiledata': [(lambda: pd.DataFrame(data={'caller_id': ['A'], 'timestamp': ['2021-01-01']}), ValueError),
+                   (lambda: pd.DataFrame(data={'caller_id': ['A'], 'volume': ['100']}), ValueError)],
+    'mobilemoney': [(lambda: pd.DataFrame(data={'txn_type': ['cashin'], 'caller_id': ['A'], 'recipient_id': ['B'],
+                                                'timestamp': ['2021-01-01']}), ValueError),
+                    (lambda: pd.DataFrame(data={'txn_type': ['cash-in'], 'caller_id': ['A'], 'recipient_id': ['B'],
+                                                'timestamp': ['2021-01-01'], 'amount': [10]}), ValueError)],
+    'shapefiles': [(lambda: pd.DataFrame(data={'region': ['X']}), ValueError),
+                   (lambda: pd.DataFrame(data={'geometry': ['A']}), ValueError),
+                   (lambda: pd.DataFrame(data={'region': ['X'], 'geometry': ['A']}), AssertionError)],
+    'labels': [(lambda: pd.DataFrame(data={'name': ['A']}), ValueError),
+               (lambda: pd.DataFrame(data={'label': ['50']}), ValueError)]
 }
 
+# Loaders which can be given a dataframe directly, instead of reading from the path in the config file
+LOADERS_ACCEPTING_DATAFRAMES = ['cdr', 'antennas', 'recharges', 'mobiledata', 'mobilemoney']
+
+# (loader name, malformed dataframe factory, key of its spark counterpart, expected error, whether the dataframe is
+# read from csv or passed directly). Only cases that go through the mocked spark csv reader get a spark key: the
+# others would never use the converted dataframe.
+malformed_load_cases = [
+    pytest.param(loader, dataframe_factory,
+                 (loader, i) if style == 'csv' and loader != 'shapefiles' else None,
+                 expected_error, style, id=f'{loader}-{i}-{style}')
+    for loader, cases in malformed_dataframes_and_errors.items()
+    for i, (dataframe_factory, expected_error) in enumerate(cases)
+    for style in (['csv', 'df'] if loader in LOADERS_ACCEPTING_DATAFRAMES else ['csv'])
+]
+
+
+@functools.lru_cache(maxsize=None)
+def _malformed_geodataframe(dataframe_factory: Callable[[], PandasDataFrame]) -> GeoDataFrame:
+    """
+    Build the GeoDataFrame for a malformed shapefile case once, to be shared by both datastore classes. The shapefile
+    loader raises on these before modifying them, so sharing is safe.
+    """
+    return GeoDataFrame(dataframe_factory())
+
+
 PROJECT_ROOT = Path(__file__).parent.parent
 
+# Up to this many rows, a spark dataframe's size is checked by fetching rows rather than running a full count
+MAX_ROWS_TO_TAKE = 1000
+
+
+def assert_spark_rows(df: SparkDataFrame, n: int) -> None:
+    """
+    Assert that df is a spark dataframe with n rows, picking the cheapest check for its size
+    """
+    assert isinstance(df, SparkDataFrame)
+    if n <= MAX_ROWS_TO_TAKE:
+        assert len(df.take(n + 1)) == n
+    else:
+        assert df.count() == n
+
+
+def _install_csv_mock(mock_dataframe_reader, spark: SparkSession, df: PandasDataFrame) -> None:
+    """
+    Make the patched DataFrameReader return df, converted to spark only once the test body needs it
+    """
+    mock_dataframe_reader.return_value.csv.return_value = spark.createDataFrame(df)
+
+
+def build_datastore(datastore_class: Type[DataStore], spark_session: SparkSession) -> DataStore:
+    """
+    Build a datastore from the test config around the shared spark session, rather than having it (and its IOUtils)
+    rebuild the session from config. get_spark_session is patched where it was imported, not in helpers.utils.
+
+    Each datastore class writes its outputs to its own subdirectory of the configured working directory, since the
+    classes' tests may run at the same time on different xdist workers.
+    """
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for module in ('cider.datastore', 'helpers.io_utils'):
+            monkeypatch.setattr(f'{module}.get_spark_session', lambda cfg: spark_session)
+        out = datastore_class(config_file_path_string="configs/test_config.yml")
+    out.working_directory_path = out.working_directory_path / datastore_class.__name__
+    make_dir(out.working_directory_path / 'datasets')
+    return out
+
+
+# Attributes set by the datastore loaders, which must not leak from one test to the next
+LOADED_ATTRIBUTES = ['cdr', 'antennas', 'recharges', 'mobiledata', 'mobilemoney', 'home_ground_truth',
+                     'poverty_scores', 'features', 'labels', 'merged', 'x', 'y', 'weights', 'targeting',
+                     'weighted_targeting', 'unweighted_targeting', 'fairness', 'weighted_fairness',
+                     'unweighted_fairness', 'rwi', 'survey_data', 'phone_numbers_to_featurize']
+
 
-@pytest.mark.parametrize("datastore_class", [DataStore, OptDataStore])
+@pytest.mark.parametrize("datastore_class", [DataStore, OptDataStore], scope="session")
 class TestDatastoreClasses:
     """All the tests related to objects that implement Datastore."""
 
@@ -106,275 +180,243 @@ class TestDatastoreClasses:
         with pytest.raises(expected_exception):
             datastore = datastore_class(config_file_path_string=config_file_path)
 
+    @pytest.fixture(scope="session")
+    def autospec_dataframe_reader(self):
+        """Autospec of DataFrameReader, built once since autospeccing introspects the whole pyspark class."""
+        return create_autospec(DataFrameReader)
+
     @pytest.fixture()
-    def mock_dataframe_reader(self, mocker: MockerFixture):
-        mock_dataframe_reader = mocker.patch("pyspark.sql.session.DataFrameReader", autospec=True)
-        return mock_dataframe_reader
+    def mock_dataframe_reader(self, mocker: MockerFixture, autospec_dataframe_reader):
+        mocker.patch("pyspark.sql.session.DataFrameReader", new=autospec_dataframe_reader)
+        yield autospec_dataframe_reader
+        # Forget this test's calls and the dataframe it made csv() return
+        autospec_dataframe_reader.reset_mock()
+        autospec_dataframe_reader.return_value.csv.reset_mock(return_value=True)
+
+    @pytest.fixture(scope="session")
+    def malformed_spark_dfs(self) -> Dict[Tuple[str, int], SparkDataFrame]:
+        """Spark versions of malformed_dataframes_and_errors, keyed by loader and case index."""
+        return {}
 
     @pytest.fixture()
-    def ds(self, datastore_class: Type[DataStore]) -> DataStore:
-        out = datastore_class(config_file_path_string="configs/test_config.yml")
+    def malformed_spark_df(self, request, spark_session: SparkSession,
+                           malformed_spark_dfs) -> Optional[SparkDataFrame]:
+        # Each malformed dataframe is built and converted the first time a test needs it, then reused
+        if request.param is None:
+            return None
+        if request.param not in malformed_spark_dfs:
+            loader, i = request.param
+            dataframe_factory, _ = malformed_dataframes_and_errors[loader][i]
+            malformed_spark_dfs[request.param] = spark_session.createDataFrame(dataframe_factory())
+        return malformed_spark_dfs[request.param]
+
+    @pytest.fixture(scope="session")
+    def ds(self, datastore_class: Type[DataStore], spark_session: SparkSession) -> DataStore:
+        return build_datastore(datastore_class, spark_session)
+
+    @pytest.fixture()
+    def ds_fresh(self, ds: DataStore) -> DataStore:
+        """Shallow copy of the session datastore, which tests are free to load data into."""
+        out = copy.copy(ds)
+        for attribute in LOADED_ATTRIBUTES:
+            out.__dict__.pop(attribute, None)
+        out.shapefiles = {}
+        # Re-bind the loading methods to the copy, otherwise load_data would populate the session datastore
+        out.data_type_to_fn_map = {data_type: getattr(out, fn.__name__)
+                                   for data_type, fn in ds.data_type_to_fn_map.items()}
         return out
 
     @pytest.mark.unit_test
-    def test_load_cdr(self, ds: Type[DataStore]) -> None:  # ds_mock_spark: DataStore
-        ds._load_cdr()
-        assert isinstance(ds.cdr, SparkDataFrame)
-        assert ds.cdr.count() == 1e5
-        assert 'day' in ds.cdr.columns
-        assert len(ds.cdr.columns) == 9
+    def test_load_cdr(self, ds_fresh: DataStore) -> None:  # ds_mock_spark: DataStore
+        ds_fresh._load_cdr()
+        assert_spark_rows(ds_fresh.cdr, 100000)
+        assert 'day' in ds_fresh.cdr.columns
+        assert len(ds_fresh.cdr.columns) == 9
 
         test_df = pd.DataFrame(data={'txn_type': ['text'], 'caller_id': ['A'], 'recipient_id': ['B'],
                                      'timestamp': ['2021-01-01'], 'duration': [60], 'international': ['domestic']})
-        ds._load_cdr(dataframe=test_df)
-        assert isinstance(ds.cdr, SparkDataFrame)
-        assert ds.cdr.count() == 1
-        assert 'day' in ds.cdr.columns
-        assert len(ds.cdr.columns) == 7
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['cdr'])
-    def test_load_cdr_raises_from_csv(self, mocker: MockerFixture, ds: DataStore, dataframe, expected_error):
-        mock_spark = mocker.patch("helpers.utils.SparkSession", autospec=True)
-        mock_read_csv = mock_spark.return_value.read.csv
-        mock_read_csv.return_value = ds.spark.createDataFrame(dataframe)
-        with pytest.raises(expected_error):
-            ds._load_cdr()
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['cdr'])
-    def test_load_cdr_raises_from_df(self, ds: DataStore, dataframe, expected_error):
-        with pytest.raises(expected_error):
-            ds._load_cdr(dataframe=dataframe)
+        ds_fresh._load_cdr(dataframe=test_df)
+        assert_spark_rows(ds_fresh.cdr, 1)
+        assert 'day' in ds_fresh.cdr.columns
+        assert len(ds_fresh.cdr.columns) == 7
 
     @pytest.mark.unit_test
-    def test_load_antennas(self, ds: Type[DataStore]) -> None:
-        ds._load_antennas()
-        assert isinstance(ds.antennas, SparkDataFrame)
-        assert ds.antennas.count() == 297
-        assert dict(ds.antennas.dtypes)['latitude'] == 'float'
-        assert len(ds.antennas.columns) == 4
+    def test_load_antennas(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_antennas()
+        assert_spark_rows(ds_fresh.antennas, 297)
+        assert dict(ds_fresh.antennas.dtypes)['latitude'] == 'float'
+        assert len(ds_fresh.antennas.columns) == 4
 
         test_df = pd.DataFrame(data={'antenna_id': ['1'], 'latitude': ['10'], 'longitude': ['25.3']})
-        ds._load_antennas(dataframe=test_df)
-        assert isinstance(ds.antennas, SparkDataFrame)
-        assert ds.antennas.count() == 1
-        assert dict(ds.antennas.dtypes)['latitude'] == 'float'
-        assert len(ds.antennas.columns) == 3
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['antennas'])
-    def test_load_antennas_raises_from_csv(self, mocker: MockerFixture, ds: DataStore, dataframe, expected_error):
-        mock_spark = mocker.patch("helpers.utils.SparkSession", autospec=True)
-        mock_read_csv = mock_spark.return_value.read.csv
-        mock_read_csv.return_value = ds.spark.createDataFrame(dataframe)
-        with pytest.raises(expected_error):
-            ds._load_antennas()
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['antennas'])
-    def test_load_antennas_raises_from_df(self, ds: DataStore, dataframe, expected_error):
-        with pytest.raises(expected_error):
-            ds._load_antennas(dataframe=dataframe)
+        ds_fresh._load_antennas(dataframe=test_df)
+        assert_spark_rows(ds_fresh.antennas, 1)
+        assert dict(ds_fresh.antennas.dtypes)['latitude'] == 'float'
+        assert len(ds_fresh.antennas.columns) == 3
 
     @pytest.mark.unit_test
-    def test_load_recharges(self, ds: Type[DataStore]) -> None:
-        ds._load_recharges()
-        assert isinstance(ds.recharges, SparkDataFrame)
-        assert ds.recharges.count() == 1e4
-        assert len(ds.recharges.columns) == 4
+    def test_load_recharges(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_recharges()
+        assert_spark_rows(ds_fresh.recharges, 10000)
+        assert len(ds_fresh.recharges.columns) == 4
 
         test_df = pd.DataFrame(data={'caller_id': ['A'], 'amount': ['100'], 'timestamp': ['2020-01-01']})
-        ds._load_recharges(dataframe=test_df)
-        assert isinstance(ds.recharges, SparkDataFrame)
-        assert ds.recharges.count() == 1
-        assert len(ds.recharges.columns) == 4
+        ds_fresh._load_recharges(dataframe=test_df)
+        assert_spark_rows(ds_fresh.recharges, 1)
+        assert len(ds_fresh.recharges.columns) == 4
 
     @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['recharges'])
-    def test_load_recharges_raises_from_csv(self, mock_dataframe_reader, ds: DataStore, dataframe, expected_error):
-        mock_dataframe_reader.return_value.csv.return_value = ds.spark.createDataFrame(dataframe)
-        with pytest.raises(expected_error):
-            ds._load_recharges()
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['recharges'])
-    def test_load_recharges_raises_from_df(self, ds: DataStore, dataframe, expected_error):
-        with pytest.raises(expected_error):
-            ds._load_recharges(dataframe=dataframe)
-
-    @pytest.mark.unit_test
-    def test_load_mobiledata(self, ds: Type[DataStore]) -> None:
-        ds._load_mobiledata()
-        assert isinstance(ds.mobiledata, SparkDataFrame)
-        assert ds.mobiledata.count() == 1e4
-        assert len(ds.mobiledata.columns) == 4
+    def test_load_mobiledata(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_mobiledata()
+        assert_spark_rows(ds_fresh.mobiledata, 10000)
+        assert len(ds_fresh.mobiledata.columns) == 4
 
         test_df = pd.DataFrame(data={'caller_id': ['A'], 'volume': ['100'], 'timestamp': ['2020-01-01']})
-        ds._load_mobiledata(dataframe=test_df)
-        assert isinstance(ds.mobiledata, SparkDataFrame)
-        assert ds.mobiledata.count() == 1
-        assert len(ds.mobiledata.columns) == 4
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['mobiledata'])
-    def test_load_mobiledata_raises_from_csv(self, mock_dataframe_reader: MockerFixture, ds: DataStore, dataframe,
-                                             expected_error):
-        mock_dataframe_reader.return_value.csv.return_value = ds.spark.createDataFrame(dataframe)
-        with pytest.raises(expected_error):
-            ds._load_mobiledata()
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['mobiledata'])
-    def test_load_mobiledata_raises_from_df(self, ds: DataStore, dataframe, expected_error):
-        with pytest.raises(expected_error):
-            ds._load_mobiledata(dataframe=dataframe)
+        ds_fresh._load_mobiledata(dataframe=test_df)
+        assert_spark_rows(ds_fresh.mobiledata, 1)
+        assert len(ds_fresh.mobiledata.columns) == 4
 
     @pytest.mark.unit_test
-    def test_load_mobilemoney(self, ds: Type[DataStore]) -> None:
-        ds._load_mobilemoney()
-        assert isinstance(ds.mobilemoney, SparkDataFrame)
-        assert ds.mobilemoney.count() == 1e4
-        assert len(ds.mobilemoney.columns) == 10
+    def test_load_mobilemoney(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_mobilemoney()
+        assert_spark_rows(ds_fresh.mobilemoney, 10000)
+        assert len(ds_fresh.mobilemoney.columns) == 10
 
         test_df = pd.DataFrame(data={'txn_type': ['cashin'], 'caller_id': ['A'], 'recipient_id': ['B'],
                                      'timestamp': ['2021-01-01'], 'amount': [10]})
-        ds._load_mobilemoney(dataframe=test_df)
-        assert isinstance(ds.mobilemoney, SparkDataFrame)
-        assert ds.mobilemoney.count() == 1
-        assert len(ds.mobilemoney.columns) == 6
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['mobilemoney'])
-    def test_load_mobilemoney_raises_from_csv(self, mock_dataframe_reader: MockerFixture, ds: DataStore, dataframe,
-                                              expected_error):
-        mock_dataframe_reader.return_value.csv.return_value = ds.spark.createDataFrame(dataframe)
-        with pytest.raises(expected_error):
-            ds._load_mobilemoney()
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['mobilemoney'])
-    def test_load_mobilemoney_raises_from_df(self, ds: DataStore, dataframe, expected_error):
-        with pytest.raises(expected_error):
-            ds._load_mobilemoney(dataframe=dataframe)
-
-    @pytest.mark.unit_test
-    def test_load_shapefiles(self, ds: Type[DataStore]) -> None:
-        ds._load_shapefiles()
-        assert isinstance(ds.shapefiles, dict)
-        assert 'regions' in ds.shapefiles
-        assert isinstance(ds.shapefiles['regions'], GeoDataFrame)
-        assert len(ds.shapefiles) == 2
+        ds_fresh._load_mobilemoney(dataframe=test_df)
+        assert_spark_rows(ds_fresh.mobilemoney, 1)
+        assert len(ds_fresh.mobilemoney.columns) == 6
 
     @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['shapefiles'])
-    def test_load_shapefiles_raises_from_csv(self, mocker: MockerFixture, ds: Type[DataStore], dataframe,
-                                             expected_error) -> None:
-        mock_geodataframe_reader = mocker.patch("helpers.io_utils.gpd.read_file", autospec=True)
-        mock_geodataframe_reader.return_value = GeoDataFrame(dataframe)
-        with pytest.raises(expected_error):
-            ds._load_shapefiles()
+    def test_load_shapefiles(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_shapefiles()
+        assert isinstance(ds_fresh.shapefiles, dict)
+        assert 'regions' in ds_fresh.shapefiles
+        assert isinstance(ds_fresh.shapefiles['regions'], GeoDataFrame)
+        assert len(ds_fresh.shapefiles) == 2
 
     @pytest.mark.unit_test
-    def test_load_home_ground_truth(self, ds: Type[DataStore]) -> None:
-        ds._load_home_ground_truth()
-        assert isinstance(ds.home_ground_truth, PandasDataFrame)
-        assert ds.home_ground_truth.shape[0] == 1e3
+    def test_load_home_ground_truth(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_home_ground_truth()
+        assert isinstance(ds_fresh.home_ground_truth, PandasDataFrame)
+        assert ds_fresh.home_ground_truth.shape[0] == 1e3
 
     @pytest.mark.unit_test
-    def test_load_poverty_scores(self, ds: Type[DataStore]) -> None:
+    def test_load_poverty_scores(self, ds_fresh: DataStore) -> None:
         # TODO: Create poverty scores fake data
-        ds._load_poverty_scores()
-        assert isinstance(ds.poverty_scores, PandasDataFrame)
+        ds_fresh._load_poverty_scores()
+        assert isinstance(ds_fresh.poverty_scores, PandasDataFrame)
 
     @pytest.mark.unit_test
-    def test_load_features(self, ds: Type[DataStore]) -> None:
-        ds._load_features()
-        assert isinstance(ds.features, SparkDataFrame)
+    def test_load_features(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_features()
+        assert isinstance(ds_fresh.features, SparkDataFrame)
 
     @pytest.mark.unit_test
-    def test_load_features_raises(self, mock_dataframe_reader: MockerFixture, ds: Type[DataStore]) -> None:
+    def test_load_features_raises(self, mock_dataframe_reader: MockerFixture, ds_fresh: DataStore) -> None:
         dataframe = pd.DataFrame(data={'user_id': ['X'], 'feat0': [50]})
-        mock_dataframe_reader.return_value.csv.return_value = ds.spark.createDataFrame(dataframe)
+        _install_csv_mock(mock_dataframe_reader, ds_fresh.spark, dataframe)
         with pytest.raises(ValueError):
-            ds._load_features()
-
-    @pytest.mark.unit_test
-    def test_load_labels(self, ds: Type[DataStore]) -> None:
-        ds._load_labels()
-        assert isinstance(ds.labels, SparkDataFrame)
-        assert ds.labels.count() == 50
-        assert len(ds.labels.columns) == 3
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("dataframe, expected_error", malformed_dataframes_and_errors['labels'])
-    def test_load_labels_raises_from_csv(self, mock_dataframe_reader, ds: Type[DataStore], dataframe,
-                                         expected_error) -> None:
-        mock_dataframe_reader.return_value.csv.return_value = ds.spark.createDataFrame(dataframe)
-        with pytest.raises(expected_error):
-            ds._load_labels()
-
-    @pytest.mark.unit_test
-    def test_load_targeting(self, ds: Type[DataStore]) -> None:
-        ds._load_targeting()
-        assert isinstance(ds.targeting, PandasDataFrame)
-        assert isinstance(ds.weighted_targeting, PandasDataFrame)
-        assert isinstance(ds.unweighted_targeting, PandasDataFrame)
-        assert 'random' in ds.targeting.columns
-        assert (ds.unweighted_targeting['weight'].values == np.ones(1000)).all()
-        new_len = ds.weighted_targeting.drop_duplicates()['weight'].sum()
-        assert ds.weighted_targeting.shape[0] == new_len
+            ds_fresh._load_features()
 
     @pytest.mark.unit_test
-    def test_load_fairness(self, ds: Type[DataStore]) -> None:
-        ds._load_fairness()
-        assert isinstance(ds.fairness, PandasDataFrame)
-        assert isinstance(ds.weighted_fairness, PandasDataFrame)
-        assert isinstance(ds.unweighted_fairness, PandasDataFrame)
-        assert 'random' in ds.fairness.columns
-        assert (ds.unweighted_fairness['weight'].values == np.ones(1000)).all()
-        new_len = ds.weighted_fairness.drop_duplicates()['weight'].sum()
-        assert ds.weighted_fairness.shape[0] == new_len
+    def test_load_labels(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_labels()
+        assert_spark_rows(ds_fresh.labels, 50)
+        assert len(ds_fresh.labels.columns) == 3
 
     @pytest.mark.unit_test
-    def test_load_survey(self, ds: Type[DataStore]) -> None:
-        ds._load_survey()
-        assert isinstance(ds.survey_data, PandasDataFrame)
-        assert ds.survey_data.shape[0] == 1e3
-        assert 'weight' in ds.survey_data.columns
-        assert len(ds.survey_data.columns) == 34
+    @pytest.mark.parametrize("loader, dataframe_factory, malformed_spark_df, expected_error, style",
+                             malformed_load_cases, indirect=["malformed_spark_df"])
+    def test_load_raises(self, mocker: MockerFixture, mock_dataframe_reader, ds_fresh: DataStore, loader,
+                         dataframe_factory, malformed_spark_df: Optional[SparkDataFrame], expected_error,
+                         style) -> None:
+        load = getattr(ds_fresh, f'_load_{loader}')
+        if style == 'df':
+            dataframe = dataframe_factory()
+            with pytest.raises(expected_error):
+                load(dataframe=dataframe)
+        else:
+            if loader == 'shapefiles':
+                mock_geodataframe_reader = mocker.patch("helpers.io_utils.gpd.read_file", autospec=True)
+                mock_geodataframe_reader.return_value = _malformed_geodataframe(dataframe_factory)
+            else:
+                mock_dataframe_reader.return_value.csv.return_value = malformed_spark_df
+            with pytest.raises(expected_error):
+                load()
+
+    @pytest.mark.unit_test
+    def test_load_targeting(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_targeting()
+        assert isinstance(ds_fresh.targeting, PandasDataFrame)
+        assert isinstance(ds_fresh.weighted_targeting, PandasDataFrame)
+        assert isinstance(ds_fresh.unweighted_targeting, PandasDataFrame)
+        assert 'random' in ds_fresh.targeting.columns
+        assert ds_fresh.unweighted_targeting.shape[0] == 1000
+        assert (ds_fresh.unweighted_targeting['weight'].values == 1).all()
+        # Each original row is repeated 'weight' times
+        weighted = ds_fresh.weighted_targeting
+        row_columns = [c for c in weighted.columns if c != 'weight']
+        assert weighted.shape[0] == weighted.groupby(row_columns, sort=False, dropna=False)['weight'].first().sum()
+
+    @pytest.mark.unit_test
+    def test_load_fairness(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_fairness()
+        assert isinstance(ds_fresh.fairness, PandasDataFrame)
+        assert isinstance(ds_fresh.weighted_fairness, PandasDataFrame)
+        assert isinstance(ds_fresh.unweighted_fairness, PandasDataFrame)
+        assert 'random' in ds_fresh.fairness.columns
+        assert ds_fresh.unweighted_fairness.shape[0] == 1000
+        assert (ds_fresh.unweighted_fairness['weight'].values == 1).all()
+        # Each original row is repeated 'weight' times
+        weighted = ds_fresh.weighted_fairness
+        row_columns = [c for c in weighted.columns if c != 'weight']
+        assert weighted.shape[0] == weighted.groupby(row_columns, sort=False, dropna=False)['weight'].first().sum()
+
+    @pytest.mark.unit_test
+    def test_load_survey(self, ds_fresh: DataStore) -> None:
+        ds_fresh._load_survey()
+        assert isinstance(ds_fresh.survey_data, PandasDataFrame)
+        assert ds_fresh.survey_data.shape[0] == 1e3
+        assert 'weight' in ds_fresh.survey_data.columns
+        assert len(ds_fresh.survey_data.columns) == 34
 
         test_df = pd.DataFrame(data={'unique_id': ['XYZ'], 'bin0': [0], 'con0': [25]})
-        ds._load_survey(dataframe=test_df)
-        assert isinstance(ds.survey_data, PandasDataFrame)
-        assert ds.survey_data.shape[0] == 1
-        assert 'weight' in ds.survey_data.columns
-        assert len(ds.survey_data.columns) == 4
+        ds_fresh._load_survey(dataframe=test_df)
+        assert isinstance(ds_fresh.survey_data, PandasDataFrame)
+        assert ds_fresh.survey_data.shape[0] == 1
+        assert 'weight' in ds_fresh.survey_data.columns
+        assert len(ds_fresh.survey_data.columns) == 4
 
     @pytest.mark.unit_test
-    def test_merge(self, ds: Type[DataStore]) -> None:
-        ds._load_features()
-        ds._load_labels()
-        ds.merge()
+    def test_merge(self, request, ds_fresh: DataStore) -> None:
+        ds_fresh._load_features()
+        ds_fresh._load_labels()
+        # merge() runs several counts and a join over features and labels: materialize them once up front, and
+        # release them as soon as the test is done rather than at the end of the run
+        for dataset in (ds_fresh.features, ds_fresh.labels):
+            dataset.cache().count()
+            request.addfinalizer(functools.partial(dataset.unpersist, blocking=False))
+        ds_fresh.merge()
 
-        assert isinstance(ds.merged, PandasDataFrame)
-        assert ds.merged.shape[0] == 50
+        assert isinstance(ds_fresh.merged, PandasDataFrame)
+        assert ds_fresh.merged.shape[0] == 50
 
-        assert isinstance(ds.x, PandasDataFrame)
-        assert all(col not in ds.x.columns for col in ['name', 'label', 'weight'])
-        assert len(ds.x.columns) == len(ds.merged.columns) - 3
+        assert isinstance(ds_fresh.x, PandasDataFrame)
+        assert all(col not in ds_fresh.x.columns for col in ['name', 'label', 'weight'])
+        assert len(ds_fresh.x.columns) == len(ds_fresh.merged.columns) - 3
 
-        assert isinstance(ds.y, Series)
-        assert isinstance(ds.weights, Series)
-        assert ds.weights.min() >= 1
+        assert isinstance(ds_fresh.y, Series)
+        assert isinstance(ds_fresh.weights, Series)
+        assert ds_fresh.weights.min() >= 1
 
     @pytest.mark.unit_test
     @pytest.mark.parametrize("function, expected_error", [("_load_labels", ValueError),
                                                           ("_load_features", ValueError)])
-    def test_merge_raises(self, ds: Type[DataStore], function, expected_error) -> None:
+    def test_merge_raises(self, ds_fresh: DataStore, function, expected_error) -> None:
         with pytest.raises(expected_error):
-            getattr(ds, function)()
-            ds.merge()
+            getattr(ds_fresh, function)()
+            ds_fresh.merge()
 
     @pytest.mark.unit_test
     @pytest.mark.parametrize("data_type_map", [({DataType.CDR: None,
@@ -390,47 +432,47 @@ class TestDatastoreClasses:
                                                  DataType.SHAPEFILES: None,
                                                  DataType.HOME_GROUND_TRUTH: None,
                                                  DataType.POVERTY_SCORES: None})])
-    def test_load_data(self, ds: Type[DataStore], data_type_map) -> None:
-        ds.load_data(data_type_map)
+    def test_load_data(self, ds_fresh: DataStore, data_type_map) -> None:
+        ds_fresh.load_data(data_type_map)
 
     @pytest.mark.unit_test
-    def test_filter_dates(self, ds: Type[DataStore]):
+    def test_filter_dates(self, ds_fresh: DataStore):
         # Load two datasets
-        ds._load_recharges()
-        ds._load_mobiledata()
+        ds_fresh._load_recharges()
+        ds_fresh._load_mobiledata()
         min_date, max_date = datetime(2020, 1, 1), datetime(2020, 2, 29)
 
         # Check that filtering with larger boundaries doesn't change anything
-        ds.filter_dates(min_date - timedelta(days=1), max_date + timedelta(days=1))
-        assert ds.recharges.agg(F.min('day')).collect()[0][0] == min_date
-        assert ds.recharges.agg(F.max('day')).collect()[0][0] == max_date
-        assert ds.mobiledata.agg(F.min('day')).collect()[0][0] == min_date
-        assert ds.mobiledata.agg(F.max('day')).collect()[0][0] == max_date
+        ds_fresh.filter_dates(min_date - timedelta(days=1), max_date + timedelta(days=1))
+        assert ds_fresh.recharges.agg(F.min('day')).collect()[0][0] == min_date
+        assert ds_fresh.recharges.agg(F.max('day')).collect()[0][0] == max_date
+        assert ds_fresh.mobiledata.agg(F.min('day')).collect()[0][0] == min_date
+        assert ds_fresh.mobiledata.agg(F.max('day')).collect()[0][0] == max_date
 
         # Check that filtering with smaller boundaries works
         new_min_date, new_max_date = min_date + timedelta(days=1), max_date - timedelta(days=1)
-        ds.filter_dates(new_min_date, new_max_date)
-        assert ds.recharges.agg(F.min('day')).collect()[0][0] == new_min_date
-        assert ds.recharges.agg(F.max('day')).collect()[0][0] == new_max_date
-        assert ds.mobiledata.agg(F.min('day')).collect()[0][0] == new_min_date
-        assert ds.mobiledata.agg(F.max('day')).collect()[0][0] == new_max_date
-
-    @pytest.mark.unit_test
-    @pytest.mark.parametrize("df, n_rows", [(pd.DataFrame(data={'caller_id': ['A', 'A'],
-                                                                'volume': [50, 50],
-                                                                'timestamp': ['2020-01-01 12:00:00',
-                                                                              '2020-01-02 12:00:01']}),
-                                             2),
-                                            (pd.DataFrame(data={'caller_id': ['A', 'A'],
-                                                                'volume': [50, 50],
-                                                                'timestamp': ['2020-01-02 12:00:00',
-                                                                              '2020-01-02 12:00:00']}),
-                                             1)])
-    def test_deduplicate(self, mock_dataframe_reader, ds: DataStore, df, n_rows):
-        mock_dataframe_reader.return_value.csv.return_value = ds.spark.createDataFrame(df)
-        ds._load_mobiledata()
-        ds.deduplicate()
-        assert ds.mobiledata.count() == n_rows
+        ds_fresh.filter_dates(new_min_date, new_max_date)
+        assert ds_fresh.recharges.agg(F.min('day')).collect()[0][0] == new_min_date
+        assert ds_fresh.recharges.agg(F.max('day')).collect()[0][0] == new_max_date
+        assert ds_fresh.mobiledata.agg(F.min('day')).collect()[0][0] == new_min_date
+        assert ds_fresh.mobiledata.agg(F.max('day')).collect()[0][0] == new_max_date
+
+    @pytest.mark.unit_test
+    def test_deduplicate(self, mock_dataframe_reader, ds_fresh: DataStore):
+        # Both cases share one datastore and reader mock: each iteration reloads mobile data from the new mock
+        cases = [(pd.DataFrame(data={'caller_id': ['A', 'A'],
+                                     'volume': [50, 50],
+                                     'timestamp': ['2020-01-01 12:00:00', '2020-01-02 12:00:01']}),
+                  2),
+                 (pd.DataFrame(data={'caller_id': ['A', 'A'],
+                                     'volume': [50, 50],
+                                     'timestamp': ['2020-01-02 12:00:00', '2020-01-02 12:00:00']}),
+                  1)]
+        for df, n_rows in cases:
+            _install_csv_mock(mock_dataframe_reader, ds_fresh.spark, df)
+            ds_fresh._load_mobiledata()
+            ds_fresh.deduplicate()
+            assert_spark_rows(ds_fresh.mobiledata, n_rows)
 
     @pytest.mark.unit_test
     @pytest.mark.parametrize("df, threshold, n_spammers", [(pd.DataFrame(data={'txn_type': ['call', 'call'],
@@ -459,18 +501,18 @@ class TestDatastoreClasses:
                                                                                'international': ['domestic'] * 12}),
                                                             10, 0)
                                                            ])
-    def test_remove_spammers(self, mock_dataframe_reader, ds: DataStore, df, threshold, n_spammers):
-        mock_dataframe_reader.return_value.csv.return_value = ds.spark.createDataFrame(df)
-        ds._load_cdr()
-        spammers = ds.remove_spammers(spammer_threshold=threshold)
+    def test_remove_spammers(self, mock_dataframe_reader, ds_fresh: DataStore, df, threshold, n_spammers):
+        _install_csv_mock(mock_dataframe_reader, ds_fresh.spark, df)
+        ds_fresh._load_cdr()
+        spammers = ds_fresh.remove_spammers(spammer_threshold=threshold)
         assert len(spammers) == n_spammers
-        assert ds.cdr.where(col('caller_id').isin(spammers)).count() == 0
+        assert ds_fresh.cdr.where(col('caller_id').isin(spammers)).count() == 0
 
     @pytest.mark.unit_test
-    def test_remove_spammers_raises(self, ds: DataStore):
-        ds._load_recharges()
+    def test_remove_spammers_raises(self, ds_fresh: DataStore):
+        ds_fresh._load_recharges()
         with pytest.raises(ValueError):
-            _ = ds.remove_spammers(spammer_threshold=1)
+            _ = ds_fresh.remove_spammers(spammer_threshold=1)
 
     timeseries_df = pd.DataFrame(data={'day': pd.date_range(start='2020-01-01', periods=6),
                                        'count': [10, 8, 9, 12, 8, 13]})
@@ -479,11 +521,11 @@ class TestDatastoreClasses:
     @pytest.mark.parametrize("df, num_sds, n_outliers", [(timeseries_df, 2, 0),
                                                          (timeseries_df, 1.4, 1),
                                                          (timeseries_df, 0.9, 4)])
-    def test_filter_outlier_days(self, mocker: MockerFixture, ds: DataStore, df, num_sds, n_outliers):
+    def test_filter_outlier_days(self, mocker: MockerFixture, ds_fresh: DataStore, df, num_sds, n_outliers):
         mock_dataframe_reader = mocker.patch("cider.datastore.pd.read_csv", autospec=True)
         mock_dataframe_reader.return_value = df
-        ds._load_cdr()
-        outliers = ds.filter_outlier_days(num_sds=num_sds)
+        ds_fresh._load_cdr()
+        outliers = ds_fresh.filter_outlier_days(num_sds=num_sds)
         assert len(outliers) == n_outliers
 
     survey_df = pd.DataFrame(data={'unique_id': [str(x) for x in range(10)],
@@ -496,21 +538,22 @@ class TestDatastoreClasses:
                                                              (survey_df, ['con1', 'con2'], 1,
                                                               ['0', '1', '4', '6', '7', '9']),
                                                              (survey_df, ['con1', 'con2'], 2.5, [])])
-    def test_remove_survey_outliers(self, mocker: MockerFixture, ds: DataStore, df, cols, num_sds, outliers):
+    def test_remove_survey_outliers(self, mocker: MockerFixture, ds_fresh: DataStore, df, cols, num_sds, outliers):
         mock_dataframe_reader = mocker.patch("cider.datastore.pd.read_csv", autospec=True)
         mock_dataframe_reader.return_value = df
-        ds._load_survey()
-        assert set(outliers) == ds.remove_survey_outliers(cols=cols, num_sds=num_sds)
+        ds_fresh._load_survey()
+        assert set(outliers) == ds_fresh.remove_survey_outliers(cols=cols, num_sds=num_sds)
 
     @pytest.mark.unit_test
     @pytest.mark.parametrize("df, cols, expected_exception", [(survey_df, ['bin1'], TypeError),
                                                               (survey_df, ['con3'], ValueError)])
-    def test_remove_survey_outliers_raises(self, mocker: MockerFixture, ds: DataStore, df, cols, expected_exception):
+    def test_remove_survey_outliers_raises(self, mocker: MockerFixture, ds_fresh: DataStore, df, cols,
+                                           expected_exception):
         mock_dataframe_reader = mocker.patch("cider.datastore.pd.read_csv", autospec=True)
         mock_dataframe_reader.return_value = df
-        ds._load_survey()
+        ds_fresh._load_survey()
         with pytest.raises(expected_exception):
-            ds.remove_survey_outliers(cols=cols)
+            ds_fresh.remove_survey_outliers(cols=cols)
 
     @pytest.mark.unit_test
     def test_remove_survey_outliers_raises_before_load(self, ds: DataStore, ):
@@ -528,9 +571,8 @@ class TestOptDatastoreClass:
     """All the tests related to object that implement OptDatastore."""
 
     @pytest.fixture()
-    def ds(self) -> OptDataStore:
-        out = OptDataStore(config_file_path_string="configs/test_config.yml")
-        return out
+    def ds(self, spark_session: SparkSession) -> OptDataStore:
+        return build_datastore(OptDataStore, spark_session)
 
     @pytest.mark.unit_test
     @pytest.mark.parametrize("data_type_map, n_users", [({DataType.CDR: None}, 1000),